@@ -1,5 +1,46 @@
+import os
+import re
+from collections import defaultdict
+
 import pandas as pd
 
+try:
+    import pyarrow as pa
+except ImportError:  # pyarrow is optional; fall back to pandas' own string dtype
+    pa = None
+
+# Explicit KR type identifiers in priority order: specific subtypes are checked
+# before general types so the most precise classification is captured.
+SPECIFIC_KR_SUBTYPES = [
+    "A0KR", "A1KR", "A2KR", "B0KR", "B1KR", "B2KR",
+    "C0KR", "C1KR", "C2KR"
+]
+GENERAL_KR_TYPES = ["AKR", "BKR", "CKR"]
+
+# Arrow-backed strings let Series.str.extract run as a single Arrow compute
+# kernel (extract_regex) over the packed UTF-8 buffer instead of a Python loop.
+ANNOTATION_DTYPE = pd.ArrowDtype(pa.string()) if pa is not None else "string"
+
+# One named capture group per KR type. The alternation is anchored at the start of the
+# string, so the regex engine tries each type in priority order across the whole
+# annotation (not just the leftmost hit).
+KR_TYPE_PATTERN = "(?s)^(?:" + "|".join(
+    f".*?(?P<{kr_id}>{kr_id})" for kr_id in SPECIFIC_KR_SUBTYPES + GENERAL_KR_TYPES
+) + ")"
+KR_TYPE_REGEX = re.compile(KR_TYPE_PATTERN)
+
+KR_TYPE_RATIONALES = {
+    **{kr_id: f"Directly identified specific subtype '{kr_id}' in annotation string."
+       for kr_id in SPECIFIC_KR_SUBTYPES},
+    **{kr_id: f"Directly identified general type '{kr_id}' in annotation string."
+       for kr_id in GENERAL_KR_TYPES},
+}
+EMPTY_RATIONALE = "Annotation string is empty or NaN."
+UNDETERMINED_RATIONALE = "No explicit KR type found in the annotation string. Type cannot be inferred due to potential downstream modifications."
+
+# Rows per chunk when streaming the input CSV.
+CSV_CHUNK_SIZE = 200_000
+
 def assign_core_kr_type(annotation_string):
     """
     Assigns a core KR type only if it is explicitly stated in the annotation string.
@@ -11,34 +52,54 @@ def assign_core_kr_type(annotation_string):
     else:
         annotation_string = str(annotation_string)
 
-    # Define explicit KR type identifiers, checking for specific subtypes first
-    # to ensure the most precise classification is captured.
-    specific_kr_subtypes = [
-        "A0KR", "A1KR", "A2KR", "B0KR", "B1KR", "B2KR",
-        "C0KR", "C1KR", "C2KR"
-    ]
-    general_kr_types = ["AKR", "BKR", "CKR"]
-
-    # 1. Check for specific KR subtypes (e.g., A1KR)
-    for kr_id in specific_kr_subtypes:
-        if kr_id in annotation_string:
-            rationale = f"Directly identified specific subtype '{kr_id}' in annotation string."
-            return kr_id, rationale
-
-    # 2. Check for general KR types (e.g., AKR)
-    for kr_id in general_kr_types:
-        if kr_id in annotation_string:
-            rationale = f"Directly identified general type '{kr_id}' in annotation string."
-            return kr_id, rationale
-
-    # 3. Handle all other cases where no explicit KR type is found
+    # 1. Check for specific KR subtypes (e.g., A1KR), then general KR types (e.g., AKR),
+    # in a single regex pass; the matching group's name is the KR type.
+    match = KR_TYPE_REGEX.match(annotation_string)
+    if match:
+        return match.lastgroup, KR_TYPE_RATIONALES[match.lastgroup]
+
+    # 2. Handle all other cases where no explicit KR type is found
     if not annotation_string or annotation_string.lower() == "nan":
-        rationale = "Annotation string is empty or NaN."
+        rationale = EMPTY_RATIONALE
     else:
-        rationale = "No explicit KR type found in the annotation string. Type cannot be inferred due to potential downstream modifications."
+        rationale = UNDETERMINED_RATIONALE
 
     return "Undetermined", rationale
 
+def assign_core_kr_types(annotations):
+    """
+    Vectorized version of assign_core_kr_type for a whole Series of annotations.
+    Runs a single regex extraction over the column's distinct values instead of
+    calling assign_core_kr_type per row, and returns a DataFrame with the
+    'core_kr_type' and 'assignment_rationale' columns aligned to the input index.
+    """
+    index = annotations.index
+    if annotations.dtype != ANNOTATION_DTYPE:
+        annotations = annotations.fillna("").astype(str).astype(ANNOTATION_DTYPE)
+    annotations = annotations.fillna("")
+
+    # Annotations repeat heavily, so classify each distinct string once and
+    # broadcast the results back to the rows through the factorized codes.
+    codes, uniques = annotations.factorize()
+    annotations = pd.Series(uniques, dtype=annotations.dtype)
+
+    # Exactly one group matches per hit; collapse the groups to that value.
+    # Arrow reports non-participating groups as "" rather than missing.
+    matches = annotations.str.extract(KR_TYPE_PATTERN, expand=True)
+    matches = matches.mask(matches == "")
+    core_kr_type = matches.bfill(axis=1).iloc[:, 0]
+
+    rationale = core_kr_type.map(KR_TYPE_RATIONALES)
+    undetermined = core_kr_type.isna()
+    empty = (annotations == "") | (annotations.str.lower() == "nan")
+    rationale = rationale.mask(undetermined, UNDETERMINED_RATIONALE)
+    rationale = rationale.mask(undetermined & empty, EMPTY_RATIONALE)
+
+    return pd.DataFrame({
+        "core_kr_type": core_kr_type.fillna("Undetermined").to_numpy(dtype=object)[codes],
+        "assignment_rationale": rationale.to_numpy(dtype=object)[codes],
+    }, index=index)
+
 # --- Main script execution block ---
 if __name__ == "__main__":
     print("Starting KR type assignment script (Direct Annotation Only)...")
@@ -49,25 +110,41 @@ if __name__ == "__main__":
 
     try:
         print(f"Reading CSV file from: {csv_file_path}")
-        df = pd.read_csv(csv_file_path)
-        print("CSV file read successfully.")
-
-        # Ensure the 'Annotation' column exists
-        if "Annotation" not in df.columns:
-            print("Error: The CSV file must contain an 'Annotation' column.")
-        else:
-            print("Processing annotations...")
-            # Apply the assignment function
-            results = df["Annotation"].apply(assign_core_kr_type)
-            
-            # Create the new columns from the results
-            df["core_kr_type"] = [result[0] for result in results]
-            df["assignment_rationale"] = [result[1] for result in results]
-            
-            print(f"Saving processed data to: {output_csv_file_path}")
-            # Save the updated DataFrame to a new CSV file
-            df.to_csv(output_csv_file_path, index=False)
-            print(f"Processing complete. Output saved to '{output_csv_file_path}'")
+        # Read in chunks so large inputs are streamed through rather than held in memory.
+        # The other columns are passed through as text, so every chunk writes them the
+        # same way (dtype inference per chunk could turn an int column into floats halfway).
+        reader = pd.read_csv(csv_file_path, dtype=defaultdict(lambda: str, Annotation=ANNOTATION_DTYPE),
+                             engine="c", chunksize=CSV_CHUNK_SIZE)
+
+        # Chunks go to a temporary file that replaces the output at the end, so the input
+        # is never truncated while it is still being read (e.g. when both paths are the same).
+        tmp_output_path = f"{output_csv_file_path}.tmp-{os.getpid()}"
+        try:
+            with reader:
+                kr_columns = ["core_kr_type", "assignment_rationale"]
+                for chunk_number, df in enumerate(reader):
+                    # Ensure the 'Annotation' column exists
+                    if "Annotation" not in df.columns:
+                        print("Error: The CSV file must contain an 'Annotation' column.")
+                        break
+
+                    print(f"Processing annotations (chunk {chunk_number + 1})...")
+                    # Assign KR types for the whole chunk in one vectorized pass
+                    df[kr_columns] = assign_core_kr_types(df["Annotation"])[kr_columns]
+
+                    # Write the first chunk with a header, then append the rest
+                    first_chunk = chunk_number == 0
+                    if first_chunk:
+                        print(f"Saving processed data to: {output_csv_file_path}")
+                    df.to_csv(tmp_output_path, mode="w" if first_chunk else "a",
+                              header=first_chunk, index=False)
+                else:
+                    os.replace(tmp_output_path, output_csv_file_path)
+                    print(f"Processing complete. Output saved to '{output_csv_file_path}'")
+        finally:
+            # Only left behind if processing stopped early
+            if os.path.exists(tmp_output_path):
+                os.remove(tmp_output_path)
 
     except FileNotFoundError:
         print(f"Error: The file '{csv_file_path}' was not found. Please check the path and try again.")
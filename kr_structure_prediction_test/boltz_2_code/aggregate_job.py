@@ -5,35 +5,48 @@ import re
 import shutil
 import json
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
+from boltz_utils import IO_THREADS, available_cpus, json_loads
+
+# Output subfolder for each type of predicted file copied into the final output.
+FINAL_SUBDIRS = {
+    'pdb': "final_pdbs",
+    'pae': "final_pae",
+    'plddt': "final_plddt",
+    'confidence_json': "final_confidence_json",
+    'affinity_json': "final_affinity_json",
+    'pre_affinity': "final_pre_affinity",
+    'pde': "final_pde",
+}
+
+# Top-level scalar metrics copied from each confidence JSON.
+CONFIDENCE_TOP_KEYS = ['confidence_score', 'ptm', 'iptm', 'ligand_iptm', 'protein_iptm',
+                       'complex_plddt', 'complex_iplddt', 'complex_pde', 'complex_ipde']
+
 def parse_confidence_json(json_path):
     """
     Reads a confidence JSON file and flattens its metrics into a dictionary.
     For nested dictionaries (chains_ptm, pair_chains_iptm) the keys are flattened with underscores.
     """
-    with open(json_path, 'r') as f:
-        data = json.load(f)
-    
-    metrics = {}
-    # Top-level scalar keys
-    top_keys = ['confidence_score', 'ptm', 'iptm', 'ligand_iptm', 'protein_iptm',
-                'complex_plddt', 'complex_iplddt', 'complex_pde', 'complex_ipde']
-    for key in top_keys:
-        if key in data:
-            metrics[key] = data[key]
+    with open(json_path, 'rb') as f:
+        data = json_loads(f.read())
     
-    # Flatten chains_ptm
-    if 'chains_ptm' in data and isinstance(data['chains_ptm'], dict):
-        for chain, val in data['chains_ptm'].items():
-            metrics[f'chains_ptm_{chain}'] = val
-
-    # Flatten pair_chains_iptm
-    if 'pair_chains_iptm' in data and isinstance(data['pair_chains_iptm'], dict):
-        for chain_i, subdict in data['pair_chains_iptm'].items():
-            if isinstance(subdict, dict):
-                for chain_j, val in subdict.items():
-                    metrics[f'pair_chains_iptm_{chain_i}_{chain_j}'] = val
+    chains_ptm = data.get('chains_ptm')
+    if not isinstance(chains_ptm, dict):
+        chains_ptm = {}
+    pair_chains_iptm = data.get('pair_chains_iptm')
+    if not isinstance(pair_chains_iptm, dict):
+        pair_chains_iptm = {}
+
+    # Top-level scalar keys, then chains_ptm and pair_chains_iptm flattened in one pass
+    metrics = {key: data[key] for key in CONFIDENCE_TOP_KEYS if key in data}
+    metrics.update({f'chains_ptm_{chain}': val for chain, val in chains_ptm.items()})
+    metrics.update({f'pair_chains_iptm_{chain_i}_{chain_j}': val
+                    for chain_i, subdict in pair_chains_iptm.items() if isinstance(subdict, dict)
+                    for chain_j, val in subdict.items()})
     return metrics
 
 def parse_affinity_json(json_path):
@@ -41,13 +54,106 @@ def parse_affinity_json(json_path):
     Reads an affinity JSON file and returns its contents as a dictionary.
     """
     try:
-        with open(json_path, 'r') as f:
-            data = json.load(f)
+        with open(json_path, 'rb') as f:
+            data = json_loads(f.read())
         return data
     except (IOError, json.JSONDecodeError) as e:
         print(f"Warning: Could not read or parse affinity JSON {json_path}: {e}")
         return {}
 
+def scan_prediction_folder(pred_folder, job_id):
+    """
+    Lists a job's predictions folder once and sorts its files by type.
+    Returns a dictionary mapping each file type (the keys of FINAL_SUBDIRS)
+    to the list of matching file paths.
+    """
+    # Per-model files: <prefix><model index><suffix>
+    model_file_patterns = {
+        'pdb': (f"{job_id}_model_", ".pdb"),
+        'pae': (f"pae_{job_id}_model_", ".npz"),
+        'plddt': (f"plddt_{job_id}_model_", ".npz"),
+        'confidence_json': (f"confidence_{job_id}_model_", ".json"),
+        'pde': (f"pde_{job_id}_model_", ".npz"),
+    }
+    # Per-job files with a fixed name
+    job_file_names = {
+        'affinity_json': f"affinity_{job_id}.json",
+        'pre_affinity': f"pre_affinity_{job_id}.npz",
+    }
+
+    files = {file_type: [] for file_type in FINAL_SUBDIRS}
+    with os.scandir(pred_folder) as entries:
+        for entry in entries:
+            name = entry.name
+            matched_types = [file_type for file_type, (prefix, suffix) in model_file_patterns.items()
+                             if name.startswith(prefix) and name.endswith(suffix)]
+            matched_types += [file_type for file_type, file_name in job_file_names.items()
+                              if name == file_name]
+            # Only regular files are parsed or copied. DirEntry.is_file() uses the type
+            # reported by scandir, so this costs no extra stat call on most filesystems.
+            if matched_types and entry.is_file():
+                for file_type in matched_types:
+                    files[file_type].append(entry.path)
+    return files
+
+def fast_copy(src, dst):
+    """
+    Places src at dst as a hard link, so no file data is copied, replacing any
+    existing dst. Falls back to shutil.copyfile (which uses os.sendfile on Linux)
+    when linking is not possible, e.g. across filesystems. Metadata is not copied.
+    """
+    try:
+        if os.path.lexists(dst):
+            os.remove(dst)
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def parse_job(idx, row, job_id, pred_folder, final_dirs):
+    """
+    Builds the summary row for one replicate: the merged CSV row plus the confidence
+    metrics of every model and the affinity metrics found in its predictions folder
+    (pred_folder, for the job named job_id).
+    Returns (summary_row, copy_tasks), where copy_tasks lists the (source, destination)
+    pairs that place the job's files in final_dirs (empty if the folder is missing),
+    or None if the row has no Boltz filename and should be skipped.
+    """
+    if 'filename' not in row or pd.isna(row['filename']):
+        print(f"Warning: Skipping row {idx} due to missing 'filename' in Boltz CSV.")
+        return None
+
+    current_row_data = dict(row)
+
+    if not os.path.isdir(pred_folder):
+        print(f"Warning: Predictions folder {pred_folder} not found for dock {job_id}. Skipping file search.")
+        return current_row_data, []
+
+    # Walk the folder once; both metric parsing and file copying use this listing.
+    files = scan_prediction_folder(pred_folder, job_id)
+
+    # Create a dictionary to hold JSON metrics from all models.
+    json_metrics_all = {}
+    for json_file in files['confidence_json']:
+        m = re.search(r'_model_(\d+)\.json$', json_file)
+        model_idx = m.group(1) if m else "?"
+        metrics = parse_confidence_json(json_file)
+        for key, value in metrics.items():
+            json_metrics_all[f"{key}_model_{model_idx}"] = value
+
+    # Parse the affinity JSON file for this job.
+    affinity_metrics = {}
+    for affinity_json_path in files['affinity_json']:
+        affinity_metrics = parse_affinity_json(affinity_json_path)
+
+    # Combine the original row with any found metrics
+    current_row_data.update(json_metrics_all)
+    current_row_data.update(affinity_metrics)
+
+    copy_tasks = [(path, os.path.join(final_dirs[file_type], os.path.basename(path)))
+                  for file_type, paths in files.items()
+                  for path in paths]
+    return current_row_data, copy_tasks
+
 def main():
     parser = argparse.ArgumentParser(description="""
         Merge YAML CSV with Boltz replicate CSV, parse JSON confidence and affinity metrics from predictions,
@@ -63,7 +169,12 @@ def main():
                         help="Path to the final output folder (will create summary CSV and subfolders).")
     parser.add_argument('--summary_csv_name', default='final_summary.csv',
                         help="Name for the final summary CSV (default: final_summary.csv)")
+    parser.add_argument('--num_workers', type=int, default=available_cpus(),
+                        help="Number of worker processes for parsing prediction JSONs "
+                             "(default: number of CPUs this job may use, e.g. the SLURM allocation).")
     args = parser.parse_args()
+    if args.num_workers < 1:
+        parser.error("--num_workers must be at least 1.")
 
     # Load CSV files.
     df_yaml = pd.read_csv(args.yaml_csv)
@@ -75,98 +186,58 @@ def main():
     df_yaml['base_name'] = df_yaml['yaml_file'].str.replace(r'\.yaml$', '', regex=True)
 
     # In the Boltz CSV, extract the base_name from filenames like "ENTPD8_R249K_ATP_rep1.yaml"
-    def extract_base(filename):
-        if pd.isna(filename): return None
-        m = re.match(r'^(.*)_rep\d+\.yaml$', filename)
-        return m.group(1) if m else filename.rsplit('.', 1)[0]
-    df_boltz['base_name'] = df_boltz['filename'].apply(extract_base)
+    # Filenames without a replicate suffix fall back to dropping the extension.
+    base_names = df_boltz['filename'].str.extract(r'^(.*)_rep\d+\.yaml$', expand=False)
+    df_boltz['base_name'] = base_names.fillna(df_boltz['filename'].str.rsplit('.', n=1).str[0])
 
     # Merge the Boltz CSV with the YAML CSV on the base dock name.
     df_merged = pd.merge(df_boltz, df_yaml, how='left', on='base_name')
 
-    # Prepare a list to accumulate final rows.
-    final_rows = []
-
-    # For each replicate row, build the correct predictions folder path.
-    for idx, row in df_merged.iterrows():
-        # Derive the job_id directly from the boltz filename (e.g., "affinity_test_rep1")
-        if 'filename' not in row or pd.isna(row['filename']):
-            print(f"Warning: Skipping row {idx} due to missing 'filename' in Boltz CSV.")
-            continue
-        job_id = row['filename'].replace('.yaml', '')
-
-        pred_folder = (Path(args.predictions_dir) /
-                       f"boltz_results_{job_id}" /
-                       "predictions" /
-                       job_id)
-        
-        current_row_data = row.to_dict()
-
-        if not pred_folder.is_dir():
-            print(f"Warning: Predictions folder {pred_folder} not found for dock {job_id}. Skipping file search.")
-            final_rows.append(current_row_data)
-            continue
-
-        # Create a dictionary to hold JSON metrics from all models.
-        json_metrics_all = {}
-        json_pattern = f"confidence_{job_id}_model_*.json"
-        for json_file in pred_folder.glob(json_pattern):
-            m = re.search(r'_model_(\d+)\.json$', json_file.name)
-            model_idx = m.group(1) if m else "?"
-            metrics = parse_confidence_json(json_file)
-            for key, value in metrics.items():
-                json_metrics_all[f"{key}_model_{model_idx}"] = value
-
-        # Parse the affinity JSON file for this job.
-        affinity_metrics = {}
-        # Corrected pattern: affinity_<job_id>.json
-        affinity_json_path = pred_folder / f"affinity_{job_id}.json"
-        if affinity_json_path.is_file():
-            affinity_metrics = parse_affinity_json(affinity_json_path)
-        
-        # Combine the original row with any found metrics
-        current_row_data.update(json_metrics_all)
-        current_row_data.update(affinity_metrics)
-        final_rows.append(current_row_data)
-
-    # Create final DataFrame.
-    df_final = pd.DataFrame(final_rows)
+    # Derive each job_id from its boltz filename (e.g., "affinity_test_rep1") and
+    # build the matching predictions folder path for all rows at once.
+    job_ids = df_merged['filename'].astype('string').str.replace('.yaml', '', regex=False)
+    pred_folders = (os.path.join(args.predictions_dir, "boltz_results_") + job_ids +
+                    os.sep + "predictions" + os.sep + job_ids)
 
     # Create output subdirectories.
     output_dir = Path(args.output_dir)
-    final_pdb_dir = output_dir / "final_pdbs"
-    final_pae_dir = output_dir / "final_pae"
-    final_plddt_dir = output_dir / "final_plddt"
-    final_conf_dir = output_dir / "final_confidence_json"
-    final_affinity_json_dir = output_dir / "final_affinity_json"
-    final_pre_affinity_dir = output_dir / "final_pre_affinity"
-    final_pde_dir = output_dir / "final_pde"
-
-    for subdir in [final_pdb_dir, final_pae_dir, final_plddt_dir, final_conf_dir,
-                   final_affinity_json_dir, final_pre_affinity_dir, final_pde_dir]:
-        subdir.mkdir(parents=True, exist_ok=True)
-
-    # Copy predicted files for each unique job.
-    unique_job_yamls = df_merged['filename'].dropna().unique()
-    for job_yaml in unique_job_yamls:
-        job_id = job_yaml.replace('.yaml', '')
-        pred_folder = (Path(args.predictions_dir) /
-                       f"boltz_results_{job_id}" /
-                       "predictions" /
-                       job_id)
-        if not pred_folder.is_dir():
-            continue
-
-        # --- Copy all file types using the reliable job_id and corrected patterns ---
-        for f in pred_folder.glob(f"{job_id}_model_*.pdb"): shutil.copy2(f, final_pdb_dir / f.name)
-        for f in pred_folder.glob(f"pae_{job_id}_model_*.npz"): shutil.copy2(f, final_pae_dir / f.name)
-        for f in pred_folder.glob(f"plddt_{job_id}_model_*.npz"): shutil.copy2(f, final_plddt_dir / f.name)
-        for f in pred_folder.glob(f"confidence_{job_id}_model_*.json"): shutil.copy2(f, final_conf_dir / f.name)
-        
-        # Corrected patterns for new files
-        for f in pred_folder.glob(f"affinity_{job_id}.json"): shutil.copy2(f, final_affinity_json_dir / f.name)
-        for f in pred_folder.glob(f"pre_affinity_{job_id}.npz"): shutil.copy2(f, final_pre_affinity_dir / f.name)
-        for f in pred_folder.glob(f"pde_{job_id}_model_*.npz"): shutil.copy2(f, final_pde_dir / f.name)
+    # Kept as plain strings so per-file destinations are a cheap os.path.join.
+    final_dirs = {file_type: str(output_dir / subdir) for file_type, subdir in FINAL_SUBDIRS.items()}
+    for subdir in final_dirs.values():
+        os.makedirs(subdir, exist_ok=True)
+
+    # Parse each replicate's prediction JSONs in parallel; rows are independent.
+    # Rows without a 'filename' come back as None and are dropped.
+    # Each job's folder is scanned once, and its files are handed to a thread pool
+    # for copying (I/O bound) as soon as that job has been parsed.
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor, \
+         ThreadPoolExecutor(max_workers=IO_THREADS) as copier:
+        parsed_rows = executor.map(partial(parse_job, final_dirs=final_dirs),
+                                   df_merged.index, df_merged.to_dict('records'),
+                                   job_ids, pred_folders, chunksize=32)
+        final_rows = []
+        copy_futures = {}
+        for parsed in parsed_rows:
+            if parsed is None:
+                continue
+            row_data, copy_tasks = parsed
+            final_rows.append(row_data)
+            # Replicate rows can repeat a job; copy its files only once.
+            if row_data['filename'] not in copy_futures:
+                copy_futures[row_data['filename']] = [copier.submit(fast_copy, src, dst)
+                                                      for src, dst in copy_tasks]
+
+        # Wait for the copies, re-raising the first error.
+        for futures in copy_futures.values():
+            for future in futures:
+                future.result()
+
+    # Create final DataFrame column by column. Rows carry different model_* keys, so
+    # collect the union of keys once (in first-seen order, matching the column order
+    # pandas would give the list of dicts) and fill missing values with None.
+    columns = list(dict.fromkeys(key for row in final_rows for key in row))
+    df_final = pd.DataFrame({key: [row.get(key) for row in final_rows] for key in columns},
+                            columns=columns)
 
     # Write out the final summary CSV.
     summary_csv_path = output_dir / args.summary_csv_name
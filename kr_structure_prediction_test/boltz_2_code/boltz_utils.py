@@ -0,0 +1,36 @@
+"""
+Helpers shared by the scripts in this folder (write_yamls.py, aggregate_job.py).
+"""
+import json
+import os
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; json_loads then uses the stdlib parser only
+    orjson = None
+
+def available_cpus():
+    """
+    Returns the number of CPUs this process may run on. Under SLURM that is the job's
+    allocation (--cpus-per-task), not every core on the node as os.cpu_count() reports.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # no affinity API (e.g. macOS)
+        return os.cpu_count() or 1
+
+# Number of threads for I/O-bound work such as copying or writing many small files.
+IO_THREADS = min(32, available_cpus() * 4)
+
+def json_loads(data):
+    """
+    Parses JSON text or bytes, with orjson when it is installed. orjson only accepts
+    strict JSON, so anything it rejects (e.g. the NaN/Infinity that json.dump writes
+    for non-finite floats) is retried with the stdlib parser, which also accepts bytes.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
@@ -6,12 +6,15 @@ import shutil
 import time
 import csv
 import re
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 def duplicate_yaml_files(input_dir, num_replicates):
     """
     Creates a subfolder named 'replicates' inside input_dir,
-    copies all YAML files, and duplicates each file num_replicates times,
-    appending '_repN' to the filename.
+    and hard-links (or copies, if linking fails) each YAML file there
+    num_replicates times, appending '_repN' to the filename.
     Returns the path to the replicates folder.
     """
     replicates_dir = os.path.join(input_dir, "replicates")
@@ -28,7 +31,13 @@ def duplicate_yaml_files(input_dir, num_replicates):
         for rep in range(1, num_replicates + 1):
             new_filename = f"{base}_rep{rep}{ext}"
             new_filepath = os.path.join(replicates_dir, new_filename)
-            shutil.copy(file_path, new_filepath)
+            # Boltz only reads the YAML, so a hard link is enough; copy if linking fails.
+            if os.path.lexists(new_filepath):
+                os.remove(new_filepath)
+            try:
+                os.link(file_path, new_filepath)
+            except OSError:
+                shutil.copy(file_path, new_filepath)
     return replicates_dir
 
 def construct_command(args, yaml_filepath):
@@ -90,6 +99,63 @@ def extract_replicate_number(filename):
     match = re.search(r"_rep(\d+)", filename)
     return int(match.group(1)) if match else 1
 
+def available_gpus():
+    """
+    Returns the GPUs this process is allowed to use, as CUDA_VISIBLE_DEVICES entries.
+    An inherited CUDA_VISIBLE_DEVICES (e.g. set by SLURM) is honored as is; otherwise
+    all GPUs torch can see are listed.
+    """
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible is not None:
+        return [gpu.strip() for gpu in visible.split(",") if gpu.strip()]
+    import torch  # installed alongside boltz; only needed when nothing was assigned
+    return [str(gpu) for gpu in range(torch.cuda.device_count())]
+
+def job_environment(gpus):
+    """
+    Returns the environment for a job pinned to the given GPUs (a list of
+    CUDA_VISIBLE_DEVICES entries), or None to inherit the current environment.
+    """
+    if gpus is None:
+        return None
+    env = os.environ.copy()
+    env["CUDA_VISIBLE_DEVICES"] = ",".join(gpus)
+    return env
+
+def run_job(args, jobs_dir, job_file, free_slots):
+    """
+    Runs boltz predict for one YAML file in jobs_dir on a slot (its GPUs, or None)
+    taken from free_slots, returning the slot when done. Jobs that exceed max_time
+    are killed; failed jobs are reported and skipped.
+    Returns the processing time in seconds.
+    """
+    yaml_path = os.path.join(jobs_dir, job_file)
+
+    # Build the boltz predict command.
+    cmd = construct_command(args, yaml_path)
+    print(f"Running command: {' '.join(cmd)}")
+
+    slot = free_slots.get()
+    env = job_environment(slot)
+    start_time = time.time()
+    try:
+        # Use timeout if max_time is specified (convert minutes to seconds).
+        if args.max_time:
+            timeout_sec = args.max_time * 60
+            subprocess.run(cmd, timeout=timeout_sec, check=True, env=env)
+        else:
+            subprocess.run(cmd, check=True, env=env)
+        elapsed = time.time() - start_time
+    except subprocess.TimeoutExpired:
+        elapsed = args.max_time * 60 if args.max_time else (time.time() - start_time)
+        print(f"Job {job_file} exceeded max_time. Moving to next file.")
+    except subprocess.CalledProcessError as e:
+        elapsed = time.time() - start_time
+        print(f"Job {job_file} failed with error: {e}. Moving to next file.")
+    finally:
+        free_slots.put(slot)
+    return elapsed
+
 def main():
     parser = argparse.ArgumentParser(
         description='Run Boltz structure prediction for a folder full of YAML configuration files.'
@@ -103,6 +169,10 @@ def main():
                         help='Maximum time (in minutes) for a single job before moving to the next file.')
     parser.add_argument('--num_replicates', type=int, default=1,
                         help='Number of times to run the same job (replicates).')
+    parser.add_argument('--parallel_jobs', type=int, default=1,
+                        help='Number of Boltz jobs to run at once. On GPU, each job gets its own block of '
+                             '--devices GPUs out of those in CUDA_VISIBLE_DEVICES (or all visible GPUs if unset). '
+                             'Default is 1 (one job at a time).')
     
     # Boltz predict options
     parser.add_argument('--out_dir', type=str, required=True,
@@ -143,6 +213,19 @@ def main():
                         help="Pairing strategy to use. Used only if --use_msa_server is set.")
     
     args = parser.parse_args()
+    if args.parallel_jobs < 1:
+        parser.error("--parallel_jobs must be at least 1.")
+
+    # With several GPU jobs at once, split the GPUs we were given into one block of
+    # --devices GPUs per slot. A single job just inherits the environment.
+    slot_gpus = [None] * args.parallel_jobs
+    if args.parallel_jobs > 1 and args.accelerator == 'gpu':
+        gpus = available_gpus()
+        needed = args.parallel_jobs * args.devices
+        if needed > len(gpus):
+            parser.error(f"--parallel_jobs {args.parallel_jobs} x --devices {args.devices} needs {needed} GPUs, "
+                         f"but only {len(gpus)} are available ({','.join(gpus) or 'none'}).")
+        slot_gpus = [gpus[slot * args.devices:(slot + 1) * args.devices] for slot in range(args.parallel_jobs)]
     
     # Always create a replicates folder, even if num_replicates == 1.
     jobs_dir = duplicate_yaml_files(args.input_dir, args.num_replicates)
@@ -154,40 +237,22 @@ def main():
         if f.endswith(('.yaml', '.yml')) and os.path.isfile(os.path.join(jobs_dir, f))
     ]
     
-    # List to hold CSV records.
-    records = []
-    
-    # Process each YAML file.
-    for job_file in job_files:
-        yaml_path = os.path.join(jobs_dir, job_file)
-        replicate_number = extract_replicate_number(job_file)
-        
-        # Build the boltz predict command.
-        cmd = construct_command(args, yaml_path)
-        print(f"Running command: {' '.join(cmd)}")
-        
-        start_time = time.time()
-        try:
-            # Use timeout if max_time is specified (convert minutes to seconds).
-            if args.max_time:
-                timeout_sec = args.max_time * 60
-                subprocess.run(cmd, timeout=timeout_sec, check=True)
-            else:
-                subprocess.run(cmd, check=True)
-            elapsed = time.time() - start_time
-        except subprocess.TimeoutExpired:
-            elapsed = args.max_time * 60 if args.max_time else (time.time() - start_time)
-            print(f"Job {job_file} exceeded max_time. Moving to next file.")
-        except subprocess.CalledProcessError as e:
-            elapsed = time.time() - start_time
-            print(f"Job {job_file} failed with error: {e}. Moving to next file.")
-        
-        # Record job details.
-        records.append({
-            'filename': job_file,
-            'replicate': replicate_number,
-            'processing_time_sec': round(elapsed, 2)
-        })
+    # Run up to parallel_jobs Boltz processes at once. Each worker thread claims a
+    # slot (its block of GPUs) for the duration of a job.
+    free_slots = queue.Queue()
+    for gpus in slot_gpus:
+        free_slots.put(gpus)
+    with ThreadPoolExecutor(max_workers=args.parallel_jobs) as executor:
+        elapsed_times = executor.map(partial(run_job, args, jobs_dir, free_slots=free_slots), job_files)
+
+        # List to hold CSV records, in the original file order.
+        records = []
+        for job_file, elapsed in zip(job_files, elapsed_times):
+            records.append({
+                'filename': job_file,
+                'replicate': extract_replicate_number(job_file),
+                'processing_time_sec': round(elapsed, 2)
+            })
     
     # Write the CSV record file to the out_dir.
     csv_filepath = os.path.join(args.out_dir, "boltz_dock_records.csv")
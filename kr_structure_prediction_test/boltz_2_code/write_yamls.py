@@ -2,10 +2,20 @@
 import argparse
 import os
 import re
-import pandas as pd
+import csv
 import yaml
 import json
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+# Use the libyaml-backed dumper when PyYAML was built with it; it is much faster.
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
+from boltz_utils import IO_THREADS, available_cpus, json_loads
 
 # Custom YAML representers to ensure specific formatting for lists and strings.
 # This makes the output YAML file cleaner and more readable.
@@ -16,16 +26,16 @@ def represent_flow_style_list(dumper, data):
     """YAML representer for FlowStyleList for inline, comma-separated lists."""
     return dumper.represent_sequence('tag:yaml.org,2002:seq', data, flow_style=True)
 
-yaml.add_representer(FlowStyleList, represent_flow_style_list)
+SafeDumper.add_representer(FlowStyleList, represent_flow_style_list)
 
 class SingleQuotedString(str):
     pass
 
 def single_quoted_representer(dumper, data):
     """YAML representer to force single quotes for strings."""
-    return dumper.represent_scalar('tag:yaml.org,2002:str', data, style="'")
+    return dumper.represent_scalar('tag:yaml.org,2002:str', str(data), style="'")
 
-yaml.add_representer(SingleQuotedString, single_quoted_representer)
+SafeDumper.add_representer(SingleQuotedString, single_quoted_representer)
 
 def generate_template_csv(filepath="boltz_template.csv"):
     """
@@ -76,59 +86,107 @@ def generate_template_csv(filepath="boltz_template.csv"):
         if header not in example_data:
             example_data[header] = ['']
 
-    df = pd.DataFrame(example_data, columns=headers)
-    df.to_csv(filepath, index=False)
+    with open(filepath, 'w', newline='') as fh:
+        writer = csv.writer(fh, lineterminator='\n')
+        writer.writerow(headers)
+        writer.writerow([example_data[header][0] for header in headers])
     print(f"Template CSV file saved to: {filepath}")
     print("Please edit this file to define your own protein-ligand complexes.")
 
-def process_row(row):
+# Matches entity type columns (e.g. 'entity_3_type'); the group is the entity index.
+ENTITY_TYPE_PATTERN = re.compile(r'entity_(\d+)_type')
+ENTITY_FIELDS = ['id', 'sequence', 'smiles', 'ccd', 'msa', 'cyclic', 'modifications']
+CONSTRAINT_KEYS = ['bonds', 'pockets', 'contacts']
+# Cell values read as True in boolean columns such as entity_*_cyclic.
+TRUE_VALUES = {'true', 't', 'yes', 'y', '1'}
+# Cell values treated as missing, the same set pandas.read_csv reads as NaN by default.
+NA_VALUES = {'#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+             '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'}
+
+def build_entity_schema(columns):
+    """
+    Scans the CSV columns once for entities and returns, in entity order, a list of
+    dictionaries mapping each entity field (e.g. 'sequence') to its column name
+    (e.g. 'entity_3_sequence').
+    """
+    type_cols = {col: ENTITY_TYPE_PATTERN.match(col).group(1)
+                 for col in columns if ENTITY_TYPE_PATTERN.match(col)}
+
+    # Sort by entity number to maintain order
+    schema = []
+    for type_col, entity_index in sorted(type_cols.items(), key=lambda item: int(item[1])):
+        cols = {field: f'entity_{entity_index}_{field}' for field in ENTITY_FIELDS}
+        cols['type'] = type_col
+        schema.append(cols)
+    return schema
+
+def build_records(rows, json_columns):
+    """
+    Turns the raw CSV rows into self-contained dictionaries for process_row: blank
+    cells and NA markers (NA_VALUES) become None and JSON columns (modifications, constraints) hold their parsed
+    values, so a row can be shipped to a worker process on its own. Cells that are
+    not valid JSON are reported once per column and skipped.
+    """
+    invalid = dict.fromkeys(json_columns, 0)
+    records = []
+    for row in rows:
+        record = {col: value if value is not None and value.strip() and value not in NA_VALUES else None
+                  for col, value in row.items()}
+        for col in json_columns:
+            if record.get(col) is not None:
+                try:
+                    record[col] = json_loads(record[col])
+                except json.JSONDecodeError:
+                    record[col] = None
+                    invalid[col] += 1
+        records.append(record)
+
+    for col, count in invalid.items():
+        if count:
+            print(f"Warning: Could not parse JSON in column '{col}' for {count} row(s). Skipping those values.", file=sys.stderr)
+    return records
+
+def process_row(row, entity_schema):
     """
-    Processes one row of the CSV to generate the YAML structure.
+    Processes one row of the CSV, as prepared by build_records, to generate the
+    YAML structure. entity_schema is the column layout from build_entity_schema.
     """
+    def present(col):
+        return row.get(col) is not None
+
     # Initialize the main dictionary structure for the YAML file.
     yaml_dict = {}
     
     # --- 1. Process all entities (proteins, ligands, etc.) ---
     sequences = []
-    entity_pattern = re.compile(r'entity_(\d+)_type')
-    entity_cols = [col for col in row.index if entity_pattern.match(col)]
-    
-    # Sort by entity number to maintain order
-    entity_keys_sorted = sorted(entity_cols, key=lambda x: int(entity_pattern.match(x).group(1)))
-    
-    for type_key in entity_keys_sorted:
-        entity_type = row[type_key]
-        if pd.isna(entity_type) or entity_type.strip() == '':
+    for cols in entity_schema:
+        if not present(cols['type']):
             continue
-            
-        entity_index = entity_pattern.match(type_key).group(1)
+        entity_type = row[cols['type']]
         
         entity_obj = {}
         entity_data = {}
 
         # The ID can be a single letter or a FlowStyleList for multiple identical chains
-        chain_ids = str(row[f'entity_{entity_index}_id']).split(',')
+        chain_ids = str(row[cols['id']]).split(',')
         entity_data['id'] = FlowStyleList(chain_ids) if len(chain_ids) > 1 else chain_ids[0]
 
         # Add sequence-like properties
-        if not pd.isna(row.get(f'entity_{entity_index}_sequence')):
-            entity_data['sequence'] = row[f'entity_{entity_index}_sequence']
-        if not pd.isna(row.get(f'entity_{entity_index}_smiles')):
-            entity_data['smiles'] = SingleQuotedString(row[f'entity_{entity_index}_smiles'])
-        if not pd.isna(row.get(f'entity_{entity_index}_ccd')):
-            entity_data['ccd'] = row[f'entity_{entity_index}_ccd']
-        if not pd.isna(row.get(f'entity_{entity_index}_msa')):
-            entity_data['msa'] = row[f'entity_{entity_index}_msa']
-        if not pd.isna(row.get(f'entity_{entity_index}_cyclic')) and row[f'entity_{entity_index}_cyclic']:
-             entity_data['cyclic'] = bool(row[f'entity_{entity_index}_cyclic'])
-
-        # Handle modifications as a JSON string
-        mod_col = f'entity_{entity_index}_modifications'
-        if mod_col in row and not pd.isna(row[mod_col]) and row[mod_col].strip():
-            try:
-                entity_data['modifications'] = json.loads(row[mod_col])
-            except json.JSONDecodeError:
-                print(f"Warning: Could not parse JSON in column '{mod_col}'. Skipping modifications for this entity.", file=sys.stderr)
+        if present(cols['sequence']):
+            entity_data['sequence'] = row[cols['sequence']]
+        if present(cols['smiles']):
+            entity_data['smiles'] = SingleQuotedString(row[cols['smiles']])
+        if present(cols['ccd']):
+            entity_data['ccd'] = row[cols['ccd']]
+        if present(cols['msa']):
+            entity_data['msa'] = row[cols['msa']]
+        if present(cols['cyclic']) and row[cols['cyclic']].strip().lower() in TRUE_VALUES:
+             entity_data['cyclic'] = True
+
+        # Modifications come from a JSON string, parsed up front
+        mod_col = cols['modifications']
+        if present(mod_col):
+            entity_data['modifications'] = row[mod_col]
 
         entity_obj[entity_type] = entity_data
         sequences.append(entity_obj)
@@ -138,25 +196,20 @@ def process_row(row):
 
     # --- 2. Process Constraints (bonds, pockets, contacts) ---
     constraints = []
-    constraint_keys = ['bonds', 'pockets', 'contacts']
-    for key in constraint_keys:
-        if key in row and not pd.isna(row[key]) and row[key].strip():
-            try:
-                # The column contains a JSON string representing a list of constraint dicts
-                parsed_json = json.loads(row[key])
-                if isinstance(parsed_json, list):
-                    # Wrap each item in the list with its key
-                    for item in parsed_json:
-                        constraints.append({key.rstrip('s'): item}) # e.g., 'bonds' -> 'bond'
-            except json.JSONDecodeError:
-                print(f"Warning: Could not parse JSON in constraint column '{key}'. Skipping.", file=sys.stderr)
+    for key in CONSTRAINT_KEYS:
+        # The column contains a JSON string representing a list of constraint dicts
+        items = row.get(key)
+        if isinstance(items, list):
+            # Wrap each item in the list with its key
+            for item in items:
+                constraints.append({key.rstrip('s'): item}) # e.g., 'bonds' -> 'bond'
     
     if constraints:
         yaml_dict['constraints'] = constraints
 
     # --- 3. Process Properties (e.g., affinity) ---
     properties = []
-    if 'affinity_binder' in row and not pd.isna(row['affinity_binder']):
+    if present('affinity_binder'):
         properties.append({'affinity': {'binder': row['affinity_binder']}})
     
     if properties:
@@ -164,17 +217,68 @@ def process_row(row):
         
     return yaml_dict
 
+def yaml_filename_base(row, entity_schema):
+    """
+    Returns the YAML filename (without extension) for a row prepared by build_records.
+    """
+    if row.get('foldname') is not None:
+        return row['foldname']
+    # Fallback to creating a name from entity IDs if foldname is not provided
+    num_entities = sum(row.get(cols['type']) is not None for cols in entity_schema)
+    return "_".join(str(row[f'entity_{i+1}_id']) for i in range(num_entities))
+
+def write_yaml_file(yaml_path, yaml_dict):
+    """
+    Writes one YAML structure to yaml_path.
+    """
+    # Dump to bytes in memory and write the file in one go
+    yaml_bytes = yaml.dump(
+        yaml_dict,
+        Dumper=SafeDumper,
+        encoding='utf-8',
+        default_flow_style=False,
+        indent=2,
+        sort_keys=False
+    )
+    with open(yaml_path, 'wb') as yf:
+        yf.write(yaml_bytes)
+
+def write_yaml_documents(yaml_path, yaml_dicts):
+    """
+    Writes all YAML structures to yaml_path as one multi-document YAML file, in order.
+    """
+    yaml_bytes = yaml.dump_all(
+        yaml_dicts,
+        Dumper=SafeDumper,
+        encoding='utf-8',
+        default_flow_style=False,
+        indent=2,
+        sort_keys=False
+    )
+    with open(yaml_path, 'wb') as yf:
+        yf.write(yaml_bytes)
+
 def main():
     """Main function to parse arguments and drive the script."""
     parser = argparse.ArgumentParser(
         description="Generate Boltz-2 YAML files from a CSV input. Supports multiple chains and complex constraints."
     )
     parser.add_argument('--input_csv', type=str,
-                        help="Input CSV file path containing complex definitions.")
+                        help="Input CSV file path containing complex definitions. A UTF-8 byte order mark "
+                             "(as in Excel's CSV UTF-8 export) is ignored; empty cells and NA markers such as "
+                             "NA, N/A or null are treated as missing. Other cells are copied to --csv_out as written.")
     parser.add_argument('--yaml_out_dir', type=str,
                         help="Output directory where YAML files will be written.")
     parser.add_argument('--csv_out', type=str,
                         help="Output CSV file path that includes the generated YAML filenames.")
+    parser.add_argument('--num_workers', type=int, default=available_cpus(),
+                        help="Number of worker processes for building the YAML structures "
+                             "(default: number of CPUs this job may use, e.g. the SLURM allocation).")
+    parser.add_argument('--single_file', nargs='?', const='all.yaml', default=None,
+                        help="Write all complexes as documents of one multi-document YAML file in --yaml_out_dir "
+                             "(default name: all.yaml). The output CSV gets a yaml_document column with each row's document index. "
+                             "For external tooling only: Boltz reads one document per input file, so this output "
+                             "cannot be passed to boltz predict, run_boltz.py or aggregate_job.py.")
     parser.add_argument('--generate_template', nargs='?', const='boltz_template.csv', default=None,
                         help="Generate a template CSV file. Optionally provide a filename.")
 
@@ -188,44 +292,65 @@ def main():
     # Ensure required arguments are provided if not generating a template.
     if not all([args.input_csv, args.yaml_out_dir, args.csv_out]):
         parser.error("--input_csv, --yaml_out_dir, and --csv_out are required unless using --generate_template.")
+    if args.num_workers < 1:
+        parser.error("--num_workers must be at least 1.")
 
     os.makedirs(args.yaml_out_dir, exist_ok=True)
     
+    # Read the CSV as plain strings; only the yaml_file (and yaml_document) columns are added on output.
     try:
-        df = pd.read_csv(args.input_csv)
+        # utf-8-sig drops the byte order mark Excel adds, which would otherwise end up in
+        # the first column name
+        with open(args.input_csv, newline='', encoding='utf-8-sig') as fh:
+            reader = csv.DictReader(fh)
+            rows = list(reader)
+            fieldnames = list(reader.fieldnames or [])
     except FileNotFoundError:
         print(f"Error: Input CSV file not found at '{args.input_csv}'", file=sys.stderr)
         return
         
-    yaml_file_names = []
-    
-    for idx, row in df.iterrows():
-        yaml_dict = process_row(row)
-        
-        # Determine the output filename
-        if 'foldname' in row and not pd.isna(row['foldname']) and row['foldname'].strip():
-            filename_base = row['foldname']
-        else:
-            # Fallback to creating a name from entity IDs if foldname is not provided
-            ids = [str(row[f'entity_{i+1}_id']) for i in range(len(yaml_dict.get('sequences', [])))]
-            filename_base = "_".join(ids)
-
-        yaml_filename = f"{filename_base}.yaml"
-        yaml_file_names.append(yaml_filename)
-        
-        yaml_path = os.path.join(args.yaml_out_dir, yaml_filename)
-        with open(yaml_path, 'w') as yf:
-            yaml.dump(
-                yaml_dict,
-                yf,
-                default_flow_style=False,
-                indent=2,
-                sort_keys=False
-            )
-            
-    # Add the new yaml_file column to the dataframe and save it.
-    df['yaml_file'] = yaml_file_names
-    df.to_csv(args.csv_out, index=False)
+    # Work out the column layout and which cells hold values once, up front.
+    entity_schema = build_entity_schema(fieldnames)
+    json_columns = [col for col in [cols['modifications'] for cols in entity_schema] + CONSTRAINT_KEYS
+                    if col in fieldnames]
+    records = build_records(rows, json_columns)
+
+    # Rows are independent, so build their YAML structures in parallel.
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+        yaml_dicts = list(executor.map(partial(process_row, entity_schema=entity_schema),
+                                       records, chunksize=64))
+
+    # Columns added to each row of the output CSV
+    new_columns = {}
+    if args.single_file:
+        # Every row becomes one document of a single file, in CSV order. Not usable as
+        # Boltz input (yaml.safe_load there takes one document per file).
+        write_yaml_documents(os.path.join(args.yaml_out_dir, args.single_file), yaml_dicts)
+        new_columns['yaml_file'] = [args.single_file] * len(records)
+        new_columns['yaml_document'] = list(range(len(records)))
+    else:
+        # Determine all output filenames in one pass
+        yaml_file_names = [f"{yaml_filename_base(row, entity_schema)}.yaml" for row in records]
+        # Output path -> YAML structure; a repeated filename keeps the last row, as before.
+        yaml_files = {}
+        yaml_dir_prefix = os.path.join(args.yaml_out_dir, '')
+        for yaml_filename, yaml_dict in zip(yaml_file_names, yaml_dicts):
+            yaml_files[yaml_dir_prefix + yaml_filename] = yaml_dict
+
+        # Writing many small files is I/O bound, so spread it over threads.
+        with ThreadPoolExecutor(max_workers=IO_THREADS) as writer:
+            list(writer.map(write_yaml_file, yaml_files.keys(), yaml_files.values()))
+        new_columns['yaml_file'] = yaml_file_names
+
+    # Write the input rows back out with the new column(s).
+    fieldnames += [col for col in new_columns if col not in fieldnames]
+    with open(args.csv_out, 'w', newline='') as fh:
+        writer = csv.DictWriter(fh, fieldnames=fieldnames, lineterminator='\n')
+        writer.writeheader()
+        for i, row in enumerate(rows):
+            for col, values in new_columns.items():
+                row[col] = values[i]
+            writer.writerow(row)
     
     print(f"YAML generation complete. Files are in '{args.yaml_out_dir}'.")
     print(f"Updated CSV with filenames saved to '{args.csv_out}'.")
@@ -1,42 +1,85 @@
 import os
 import argparse
+import numpy as np
 import pandas as pd
 import torch
+from torch.nn.utils.rnn import pad_sequence
 import time
+from concurrent.futures import ThreadPoolExecutor
 from transformers import AutoTokenizer, EsmForProteinFolding
 from transformers.models.esm.openfold_utils.protein import to_pdb, Protein as OFProtein
 from transformers.models.esm.openfold_utils.feats import atom14_to_atom37
 
-def convert_outputs_to_pdb(outputs):
-    """Converts the model's output tensors to a list of PDB-formatted strings."""
+def pad_batch(batch_ids, pad_token_id):
+    """
+    Pads a list of 1-D token id tensors into a batch and returns the input ids and
+    attention mask, both still on the CPU.
+    """
+    lengths = torch.tensor([len(ids) for ids in batch_ids])
+    input_ids = pad_sequence(batch_ids, batch_first=True, padding_value=pad_token_id)
+    attention_mask = (torch.arange(input_ids.shape[1]) < lengths[:, None]).long()
+    return input_ids, attention_mask
+
+def outputs_to_numpy(outputs, include_chain_index=False, include_bfactors=True):
+    """
+    Copies the model's output tensors needed for the PDBs to the CPU, once for the
+    whole batch, and returns them as a dictionary of numpy arrays. Chain indices
+    (only relevant for multi-chain inputs) and the per-atom pLDDT used as B-factors
+    are only copied when asked for.
+    """
     final_atom_positions = atom14_to_atom37(outputs["positions"][-1], outputs)
-    final_atom_positions_np = final_atom_positions.cpu().numpy()
-    final_atom_mask = outputs["atom37_atom_exists"].cpu().numpy()
+    return {
+        "atom_positions": final_atom_positions.cpu().numpy(),
+        "atom_mask": outputs["atom37_atom_exists"].cpu().numpy(),
+        "aatype": outputs["aatype"].cpu().numpy(),
+        "residue_index": outputs["residue_index"].cpu().numpy() + 1,
+        "plddt": outputs["plddt"].cpu().numpy() if include_bfactors else None,
+        "chain_index": outputs["chain_index"].cpu().numpy()
+        if include_chain_index and "chain_index" in outputs
+        else None,
+    }
 
+def convert_outputs_to_pdb(arrays, lengths):
+    """
+    Converts the output arrays from outputs_to_numpy to a list of PDB-formatted strings.
+    Each example is trimmed to its true length (lengths[i]) so padding added for
+    batching does not appear as extra residues.
+    """
+    chain_index = arrays["chain_index"]
+    # Without pLDDT the B-factor column is written as zeros
+    b_factors = arrays["plddt"] if arrays["plddt"] is not None else np.zeros_like(arrays["atom_positions"][..., 0])
     pdbs = []
-    for i in range(outputs["aatype"].shape[0]):
-        aa = outputs["aatype"][i].cpu().numpy()
-        pred_pos = final_atom_positions_np[i]
-        mask = final_atom_mask[i]
-        resid = outputs["residue_index"][i].cpu().numpy() + 1
+    for i in range(arrays["aatype"].shape[0]):
+        length = lengths[i]
         pred = OFProtein(
-            aatype=aa,
-            atom_positions=pred_pos,
-            atom_mask=mask,
-            residue_index=resid,
-            b_factors=outputs["plddt"][i].cpu().numpy(),
-            chain_index=outputs["chain_index"][i].cpu().numpy()
-            if "chain_index" in outputs
-            else None,
+            aatype=arrays["aatype"][i, :length],
+            atom_positions=arrays["atom_positions"][i, :length],
+            atom_mask=arrays["atom_mask"][i, :length],
+            residue_index=arrays["residue_index"][i, :length],
+            b_factors=b_factors[i, :length],
+            chain_index=chain_index[i, :length] if chain_index is not None else None,
         )
         pdbs.append(to_pdb(pred))
     return pdbs
 
+def write_pdbs(arrays, lengths, pdb_paths):
+    """
+    Converts a batch of output arrays to PDBs and writes example i to every path in
+    pdb_paths[i]. Runs on a background thread so it overlaps with the next batch's
+    forward pass.
+    """
+    for paths, pdb in zip(pdb_paths, convert_outputs_to_pdb(arrays, lengths)):
+        # Encoded once and written in binary with a large buffer, skipping the text layer
+        pdb_bytes = pdb.encode("ascii")
+        for pdb_path in paths:
+            with open(pdb_path, "wb", buffering=1 << 20) as f:
+                f.write(pdb_bytes)
+
 def main(args):
     """Main function to run protein structure prediction and create a summary."""
     # Load tokenizer and model
     print(f"Loading model: {args.model_name}")
-    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name, use_fast=True)
     model = EsmForProteinFolding.from_pretrained(
         args.model_name,
         low_cpu_mem_usage=args.low_cpu_mem_usage
@@ -44,13 +87,21 @@ def main(args):
 
     # Apply performance optimizations
     if args.use_fp16:
-        model.esm = model.esm.half()
+        # Run the ESM language model stem under autocast instead of casting its weights
+        # down; the folding trunk stays in full precision, as before.
+        autocast_dtype = getattr(torch, args.autocast_dtype)
+        model.esm.forward = torch.autocast(device_type="cuda", dtype=autocast_dtype)(model.esm.forward)
     torch.backends.cuda.matmul.allow_tf32 = args.allow_tf32
     model.trunk.set_chunk_size(args.chunk_size)
+    if args.use_compile:
+        # Sequence lengths vary between batches, so compile with dynamic shapes
+        model = torch.compile(model, mode="reduce-overhead", dynamic=True)
 
     # 1. Prepare output directories
     structures_dir = os.path.join(args.output_directory, "structures")
     os.makedirs(structures_dir, exist_ok=True)
+    # Resolved once; the summary's per-row paths are built from this
+    structures_dir_abs = os.path.abspath(structures_dir)
     print(f"✅ Output will be saved in: {os.path.abspath(args.output_directory)}")
 
     # 2. Process the single input CSV
@@ -63,35 +114,87 @@ def main(args):
 
         print(f"\n--- Processing {len(df)} sequences from: {args.input_csv} ---")
 
-        # 3. Iterate over proteins, predict, and collect data
-        for index, row in df.iterrows():
-            sequence = str(row[args.sequence_column])
-            protein_name = str(row[args.gene_column]).replace(" ", "_").replace("/", "_")
-
-            print(f"  ({index + 1}/{len(df)}) Predicting: {protein_name}...")
-            
-            start_time = time.time()
-            input_ids = tokenizer([sequence], return_tensors="pt", add_special_tokens=False)['input_ids'].cuda()
-            with torch.no_grad():
-                outputs = model(input_ids)
-            prediction_time = time.time() - start_time
-
-            # Extract metrics and save PDB
-            avg_plddt = outputs["plddt"][0].mean().item()
-            pdbs = convert_outputs_to_pdb(outputs)
-            pdb_filename = f"{protein_name}.pdb"
-            pdb_path = os.path.join(structures_dir, pdb_filename)
-            with open(pdb_path, "w") as f:
-                f.write(pdbs[0])
-
-            # Append data for the summary report
-            summary_data.append({
-                "gene_name": protein_name,
-                "avg_plddt": round(avg_plddt, 2),
-                "prediction_time_s": round(prediction_time, 2),
-                "sequence_length": len(sequence),
-                "pdb_file_path": os.path.abspath(pdb_path)
-            })
+        # 3. Collect the proteins to predict
+        sequence_pos = df.columns.get_loc(args.sequence_column)
+        gene_pos = df.columns.get_loc(args.gene_column)
+        sequences = []
+        protein_names = []
+        for row in df.itertuples(index=False, name=None):
+            sequences.append(str(row[sequence_pos]))
+            protein_names.append(str(row[gene_pos]).replace(" ", "_").replace("/", "_"))
+        # Rows whose names sanitize to the same PDB file: batches run in length order, so
+        # only the last such row (in input order) writes it, as a row-by-row loop would.
+        last_row_for_name = {name: i for i, name in enumerate(protein_names)}
+
+        # Predict each distinct sequence once; rows sharing a sequence reuse its structure
+        rows_by_sequence = {}
+        for i, sequence in enumerate(sequences):
+            rows_by_sequence.setdefault(sequence, []).append(i)
+        unique_sequences = list(rows_by_sequence)
+        sequence_rows = list(rows_by_sequence.values())
+        if len(unique_sequences) < len(sequences):
+            print(f"  {len(unique_sequences)} unique sequences to predict.")
+
+        # Tokenize every sequence once, up front; batches are padded from these below
+        token_ids = [torch.tensor(ids) for ids in
+                     tokenizer(unique_sequences, add_special_tokens=False)['input_ids']]
+
+        # 4. Predict in batches of similar-length sequences (to limit padding) and collect data
+        order = sorted(range(len(unique_sequences)), key=lambda u: len(unique_sequences[u]))
+        if args.use_compile and order:
+            # Compile once on a real batch so the first timed prediction doesn't pay for it
+            print("  Compiling the model (warm-up batch)...")
+            input_ids, attention_mask = pad_batch([token_ids[u] for u in order[:args.batch_size]],
+                                                  tokenizer.pad_token_id)
+            with torch.inference_mode():
+                model(input_ids.cuda(), attention_mask=attention_mask.cuda())
+        summary_by_row = {}
+        # PDB conversion and writing (CPU only) happen on a background thread while the
+        # GPU works on the next batch. to_pdb holds the GIL, so one thread is enough.
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            pending_writes = []
+            for batch_start in range(0, len(order), args.batch_size):
+                batch = order[batch_start:batch_start + args.batch_size]
+                batch_names = [protein_names[i] for u in batch for i in sequence_rows[u]]
+                print(f"  ({batch_start + 1}-{batch_start + len(batch)}/{len(unique_sequences)}) Predicting: {', '.join(batch_names)}...")
+
+                start_time = time.time()
+                batch_ids = [token_ids[u] for u in batch]
+                lengths = [len(ids) for ids in batch_ids]
+                input_ids, attention_mask = pad_batch(batch_ids, tokenizer.pad_token_id)
+                attention_mask = attention_mask.cuda()
+                with torch.inference_mode():
+                    outputs = model(input_ids.cuda(), attention_mask=attention_mask)
+                # Wall time is shared evenly across the sequences of a batch
+                prediction_time = (time.time() - start_time) / len(batch)
+
+                # Extract metrics and queue the PDBs for writing. The mean pLDDT over each
+                # sequence's real residues is computed on the GPU and fetched in one go.
+                residue_plddt = outputs["plddt"].mean(dim=-1)
+                avg_plddts = ((residue_plddt * attention_mask).sum(dim=-1) / attention_mask.sum(dim=-1)).tolist()
+                arrays = outputs_to_numpy(outputs)
+                pdb_paths = [[f"{structures_dir}/{protein_names[i]}.pdb" for i in sequence_rows[u]
+                              if last_row_for_name[protein_names[i]] == i]
+                             for u in batch]
+                pending_writes.append(writer.submit(write_pdbs, arrays, lengths, pdb_paths))
+                for j, u in enumerate(batch):
+                    avg_plddt = avg_plddts[j]
+                    for i in sequence_rows[u]:
+                        # Record data for the summary report
+                        summary_by_row[i] = {
+                            "gene_name": protein_names[i],
+                            "avg_plddt": round(avg_plddt, 2),
+                            "prediction_time_s": round(prediction_time, 2),
+                            "sequence_length": len(sequences[i]),
+                            "pdb_file_path": f"{structures_dir_abs}/{protein_names[i]}.pdb"
+                        }
+
+            # Wait for the remaining PDBs; result() re-raises any error from the writer
+            for future in pending_writes:
+                future.result()
+
+        # Report in the input order
+        summary_data = [summary_by_row[i] for i in range(len(sequences))]
 
     except FileNotFoundError:
         print(f"❌ Error: Input file not found at '{args.input_csv}'")
@@ -100,7 +203,7 @@ def main(args):
         print(f"❌ An error occurred during processing: {e}")
         return
 
-    # 4. Create and save the summary CSV
+    # 5. Create and save the summary CSV
     if summary_data:
         summary_df = pd.DataFrame(summary_data)
         summary_csv_path = os.path.join(args.output_directory, "summary_report.csv")
@@ -124,9 +227,15 @@ if __name__ == "__main__":
     # Model & Performance Arguments
     parser.add_argument("--model_name", type=str, default="facebook/esmfold_v1", help="Hugging Face model name.")
     parser.add_argument("--chunk_size", type=int, default=256, help="Trunk chunk size. Increase for GPUs with more VRAM (e.g., 256 for A40).")
+    parser.add_argument("--batch_size", type=int, default=1, help="Number of sequences predicted together per forward pass. Increase for short sequences if VRAM allows.")
     parser.add_argument("--use_fp16", action="store_true", default=True, help="Use float16 precision.")
+    parser.add_argument("--autocast_dtype", type=str, choices=["float16", "bfloat16"], default="float16",
+                        help="Reduced precision used by --use_fp16 for the language model. bfloat16 avoids overflow on Ampere or newer GPUs.")
     parser.add_argument("--allow_tf32", action="store_true", default=True, help="Enable TensorFloat32 math.")
+    parser.add_argument("--use_compile", action="store_true", help="Compile the model with torch.compile (PyTorch 2.1+). Slower start-up and more memory, faster batches.")
     parser.add_argument("--low_cpu_mem_usage", action="store_true", help="Enable low CPU memory usage for model loading.")
     
     args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("--batch_size must be at least 1.")
     main(args)
\ No newline at end of file
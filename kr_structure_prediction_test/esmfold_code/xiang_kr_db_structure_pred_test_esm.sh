@@ -21,6 +21,7 @@ INPUT_CSV="./xiang_kr_db_structure_pred_test.csv"
 OUTPUT_DIRECTORY="./xiang_kr_db_structure_pred_test"
 MODEL_NAME="facebook/esmfold_v1"
 CHUNK_SIZE=256
+BATCH_SIZE=8
 
 echo "Starting protein structure prediction..."
 
@@ -29,6 +30,7 @@ python3 esm_generate_structures.py \
     --output_directory "$OUTPUT_DIRECTORY" \
     --model_name "$MODEL_NAME" \
     --chunk_size "$CHUNK_SIZE" \
+    --batch_size "$BATCH_SIZE" \
     --use_fp16 \
     --allow_tf32
 